@@ -0,0 +1,80 @@
+"""Throughput of the sharded dispatcher vs. shard count.
+
+Usage: python bench_sharding.py [messages] [users] [max_shards]
+
+Runs the real per-message pipeline (session, heuristic extraction, state save)
+with outbound sends disabled, no OpenAI key and load shedding off, so the work
+per message is local CPU + disk. Every run starts from an empty state directory and ends when
+all shards have drained their queues.
+"""
+import os
+import sys
+import tempfile
+import time
+
+os.environ.update({
+    "SHARD_COUNT": "1",          # the bench starts shards itself
+    "OPENAI_API_KEY": "",
+    "DISABLE_OUTBOUND": "true",
+    "APPROVAL_MODE": "false",
+    # the bench floods the queues on purpose; keep every message on the full path
+    "SHED_HEURISTIC_BACKLOG": "1000000000",
+    "SHED_DEFER_BACKLOG": "1000000000",
+})
+# Never touch the working directory's state: every path points into a scratch dir
+# before app is imported (run() repoints them per shard count).
+_scratch = tempfile.mkdtemp(prefix="bench-")
+for _var, _name in (("STATE_PATH", "sessions_state.json"), ("OUTBOX_PATH", "outbox_state.json"),
+                    ("DEFERRED_PATH", "deferred_state.json"), ("LOG_PATH", "log.jsonl"),
+                    ("MEDIA_SPOOL_DIR", "media_spool"), ("PROFILE_DIR", "profiles")):
+    os.environ[_var] = os.path.join(_scratch, _name)
+
+import app  # noqa: E402
+
+
+def synthetic_message(i: int, users: int) -> dict:
+    user = f"97250{i % users:07d}"
+    texts = ["hi", "12/10/2026 at 10:30", "3 passengers", "from Tel Aviv", "to Haifa"]
+    return {
+        "from": user,
+        "id": f"wamid.bench{i}",
+        "timestamp": str(int(time.time())),
+        "type": "text",
+        "text": {"body": texts[(i // users) % len(texts)]},
+    }
+
+
+def run(shards: int, messages: int, users: int) -> float:
+    tmp = tempfile.mkdtemp(prefix=f"bench-{shards}-")
+    os.environ["STATE_PATH"] = os.path.join(tmp, "sessions_state.json")
+    os.environ["OUTBOX_PATH"] = os.path.join(tmp, "outbox_state.json")
+    os.environ["DEFERRED_PATH"] = os.path.join(tmp, "deferred_state.json")
+    os.environ["LOG_PATH"] = os.path.join(tmp, "log.jsonl")
+    app.start_shards(shards)
+    app.drain_shards()  # wait for every shard to be up
+    t0 = time.perf_counter()
+    for i in range(messages):
+        m = synthetic_message(i, users)
+        app.route_to_shard(m["from"], ("msg", m))
+    app.drain_shards()
+    elapsed = time.perf_counter() - t0
+    app.stop_shards()
+    return messages / elapsed
+
+
+def main() -> None:
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    max_shards = int(sys.argv[3]) if len(sys.argv) > 3 else (os.cpu_count() or 1)
+    counts = [n for n in (1, 2, 4, 8, 16) if n <= max_shards]
+    base = None
+    print(f"{messages} messages, {users} users")
+    print(f"{'shards':>6} {'msg/s':>10} {'speedup':>8} {'efficiency':>10}")
+    for n in counts:
+        rate = run(n, messages, users)
+        base = base or rate
+        print(f"{n:>6} {rate:>10.1f} {rate / base:>8.2f} {rate / base / n:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""gunicorn entry point: gunicorn -w 1 wsgi:app"""
+from app import app, init
+
+init()